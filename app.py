@@ -1,8 +1,6 @@
 import streamlit as st
 import main
-from PIL import Image
 import os
-import json
 
 st.set_page_config(layout="wide", page_title="식품 재료 분석기")
 
@@ -186,205 +184,181 @@ with col2:
                 "purpose": purpose
             })
             
-            # 진행 상황 표시를 위한 상태 컴포넌트
-            progress_bar = st.progress(0)
-            status_text = st.empty()
-            result_container = st.empty()
-            
-            # 초기 결과 텍스트
-            current_result = "📋 식품 재료 분석 결과 📋\n\n"
-            result_container.text_area("", value=current_result, height=700, disabled=True)
-            
-            # 이미지 분석 실행 - 단계별로 진행
-            status_text.text("이미지에서 재료를 추출하는 중...")
-            
-            # 1단계: 재료 추출
-            image = Image.open(image_path)
-            model = main.setup_gemini_model()
-            persona_prompt = main.setup_persona()
-            
-            system_prompt = f"{main.SYSTEM_INSTRUCTION}\n\n{persona_prompt}"
-            ingredient_query = {
-                "parts": [system_prompt + "\n\n이미지에서 식품에 들어간 재료를 정확히 추출해서 '^'로 구분하여 나열해주세요. 단, 식재료 영역에 감지된 객체만 보여주세요. 다른 영역은 필요없습니다. 다른 답변도 필요하지마세요.",
-                         image]
-            }
-            
-            history = []
-            query_with_role = {'role': 'user', 'parts': ingredient_query['parts']}
-            history.append(query_with_role)
-            
-            ingredient_response = model.generate_content(history)
-            history.append({'role': 'model', 'parts': [ingredient_response.text]})
-            
-            result = main.parse_ingredients(ingredient_response.text)
-            
-            # 재료 추출 결과 표시
-            current_result += "🔍 추출된 재료:\n"
-            for idx, ingredient in enumerate(result.ingredients, 1):
-                current_result += f"{idx}. {ingredient}\n"
-            current_result += "\n"
-            
-            result_container.text_area("", value=current_result, height=700, disabled=True)
-            progress_bar.progress(25)
-            
-            # 2단계: 재료 설명
-            status_text.text("재료에 대한 설명을 생성하는 중...")
-            
-            description_query = {
-                "parts": [f"다음 식품 재료에 대해 설명해주세요: {', '.join(result.ingredients)}. 다른 답변은 필요없습니다."]
-            }
-            
-            query_with_role = {'role': 'user', 'parts': description_query['parts']}
-            history.append(query_with_role)
-            
-            description_response = model.generate_content(
-                history,
-                generation_config=main.genai.GenerationConfig(
-                    temperature=main.DESCRIPTION_TEMPERATURE,
-                    response_mime_type="application/json",
-                    response_schema=main.INGREDIENT_DESCRIPTION_SCHEMA
-                )
-            )
-            
-            history.append({'role': 'model', 'parts': [description_response.text]})
-            description_data = json.loads(description_response.text)
-            descriptions = main.parse_json_items(description_data, "설명")
-            result.descriptions = descriptions
-            
-            # 재료 설명 결과 표시
-            current_result += "📚 재료 설명:\n"
-            for idx, (ingredient, description) in enumerate(result.descriptions.items(), 1):
-                current_result += f"{idx}. {ingredient}: {description}\n"
-            current_result += "\n"
-            
-            result_container.text_area("", value=current_result, height=700, disabled=True)
-            progress_bar.progress(50)
-            
-            # 3단계: 건강 팁
-            status_text.text("건강 팁을 생성하는 중...")
-            
-            health_tips_query = {
-                "parts": [f"{persona_prompt}을 참고하여 다음 재료들({', '.join(result.ingredients)})의 건강상 이점과 주의사항에 대해 조언해주세요. 다른 답변은 필요없습니다."]
-            }
-            
-            query_with_role = {'role': 'user', 'parts': health_tips_query['parts']}
-            history.append(query_with_role)
-            
-            health_tips_response = model.generate_content(
-                history,
-                generation_config=main.genai.GenerationConfig(
-                    temperature=main.DESCRIPTION_TEMPERATURE,
-                    response_mime_type="application/json",
-                    response_schema=main.HEALTH_TIPS_SCHEMA
-                )
-            )
-            
-            history.append({'role': 'model', 'parts': [health_tips_response.text]})
-            health_tips_data = json.loads(health_tips_response.text)
-            health_tips = main.parse_json_items(health_tips_data, "건강팁")
-            result.health_tips = health_tips
-            
-            # 건강 팁 결과 표시
-            current_result += "💊 건강 팁:\n"
-            for idx, (ingredient, tip) in enumerate(result.health_tips.items(), 1):
-                current_result += f"{idx}. {ingredient}: {tip}\n"
-            current_result += "\n"
-            
-            result_container.text_area("", value=current_result, height=700, disabled=True)
-            progress_bar.progress(75)
-            
-            # 4단계: 종합 평가 및 나머지 분석
-            status_text.text("종합 평가 및 추가 정보를 생성하는 중...")
-            
-            # 나머지 분석 과정 실행 (main.py의 나머지 부분)
-            # 여기서는 main.py의 나머지 분석 과정을 호출하는 대신 직접 구현
-            
-            # 종합 평가 쿼리
-            overall_query = {
-                "parts": [f"{persona_prompt}을 참고하여 다음 재료들({', '.join(result.ingredients)})에 대한 종합적인 평가와 적합도, 추가 조언을 제공해주세요."]
-            }
-            
-            query_with_role = {'role': 'user', 'parts': overall_query['parts']}
-            history.append(query_with_role)
-            
-            overall_response = model.generate_content(
-                history,
-                generation_config=main.genai.GenerationConfig(
-                    temperature=main.DESCRIPTION_TEMPERATURE,
-                    response_mime_type="application/json",
-                    response_schema=main.OVERALL_ASSESSMENT_SCHEMA
-                )
-            )
-            
-            history.append({'role': 'model', 'parts': [overall_response.text]})
-            overall_data = json.loads(overall_response.text)
-            
-            result.overall_assessment = overall_data.get("종합평가", "")
-            result.suitability = overall_data.get("적합도", "")
-            result.additional_advice = overall_data.get("추가조언", [])
-            
-            # 종합 평가 결과 표시
-            if result.overall_assessment:
-                current_result += "🧐 종합 평가:\n"
-                current_result += f"{result.overall_assessment}\n\n"
-            
-            if result.suitability:
-                current_result += "⭐ 적합도:\n"
-                current_result += f"{result.suitability}\n\n"
-            
-            if result.additional_advice:
-                current_result += "💡 추가 조언:\n"
-                for idx, advice in enumerate(result.additional_advice, 1):
-                    current_result += f"{idx}. [{advice['카테고리']}] {advice['내용']}\n"
+            with main.track_load(), main.memory_report() as memory:
+                # 진행 상황 표시를 위한 상태 컴포넌트
+                progress_bar = st.progress(0)
+                status_text = st.empty()
+                result_container = st.empty()
+            
+                # 초기 결과 텍스트
+                current_result = "📋 식품 재료 분석 결과 📋\n\n"
+                result_container.text_area("", value=current_result, height=700, disabled=True)
+            
+                # 이미지 분석 실행 - 단계별로 진행
+                status_text.text("이미지에서 재료를 추출하는 중...")
+            
+                # 1단계: 재료 추출
+                image_part = main.load_image_part(image_path)
+                persona_prompt = main.setup_persona()
+                usage_log = []
+            
+                system_prompt = f"{main.SYSTEM_INSTRUCTION}\n\n{persona_prompt}"
+                ingredient_query = {
+                    "parts": [system_prompt + "\n\n이미지에서 식품에 들어간 재료를 정확히 추출해서 '^'로 구분하여 나열해주세요. 단, 식재료 영역에 감지된 객체만 보여주세요. 다른 영역은 필요없습니다. 다른 답변도 필요하지마세요.",
+                             image_part]
+                }
+                del image_part
+            
+                history = []
+                query_with_role = {'role': 'user', 'parts': ingredient_query['parts']}
+                history.append(query_with_role)
+            
+                ingredient_response = main.generate_stage(history, "ingredients", usage_log)
+                history.append({'role': 'model', 'parts': [ingredient_response.text]})
+                main.release_image_parts(history)
+                del ingredient_query
+            
+                result = main.parse_ingredients(ingredient_response.text)
+                result.usage = usage_log
+            
+                # 재료 추출 결과 표시
+                current_result += "🔍 추출된 재료:\n"
+                for idx, ingredient in enumerate(result.ingredients, 1):
+                    current_result += f"{idx}. {ingredient}\n"
                 current_result += "\n"
             
-            result_container.text_area("", value=current_result, height=700, disabled=True)
-            progress_bar.progress(90)
+                result_container.text_area("", value=current_result, height=700, disabled=True)
+                progress_bar.progress(25)
             
-            # 5단계: 대체 재료 및 조리 팁
-            status_text.text("대체 재료 및 조리 팁을 생성하는 중...")
+                # 2단계: 재료 설명
+                status_text.text("재료에 대한 설명을 생성하는 중...")
             
-            alternatives_query = {
-                "parts": [f"{persona_prompt}을 참고하여 다음 재료들({', '.join(result.ingredients)})의 건강에 더 좋은 대체 재료와 조리 팁을 제안해주세요."]
-            }
+                description_query = {
+                    "parts": [f"다음 식품 재료에 대해 설명해주세요: {', '.join(result.ingredients)}. 다른 답변은 필요없습니다."]
+                }
             
-            query_with_role = {'role': 'user', 'parts': alternatives_query['parts']}
-            history.append(query_with_role)
+                query_with_role = {'role': 'user', 'parts': description_query['parts']}
+                history.append(query_with_role)
             
-            alternatives_response = model.generate_content(
-                history,
-                generation_config=main.genai.GenerationConfig(
-                    temperature=main.DESCRIPTION_TEMPERATURE,
-                    response_mime_type="application/json",
-                    response_schema=main.ALTERNATIVES_SCHEMA
-                )
-            )
+                description_data = main.generate_structured_stage(history, "descriptions", usage_log, main.INGREDIENT_DESCRIPTION_SCHEMA, result.ingredients)
+                descriptions = main.parse_json_items(description_data, "설명")
+                result.descriptions = descriptions
             
-            history.append({'role': 'model', 'parts': [alternatives_response.text]})
-            alternatives_data = json.loads(alternatives_response.text)
+                # 재료 설명 결과 표시
+                current_result += "📚 재료 설명:\n"
+                for idx, (ingredient, description) in enumerate(result.descriptions.items(), 1):
+                    current_result += f"{idx}. {ingredient}: {description}\n"
+                current_result += "\n"
+            
+                result_container.text_area("", value=current_result, height=700, disabled=True)
+                progress_bar.progress(50)
+            
+                # 3단계: 건강 팁
+                status_text.text("건강 팁을 생성하는 중...")
             
-            result.alternatives = alternatives_data.get("alternatives", [])
-            result.cooking_tips = alternatives_data.get("조리팁", "")
+                health_tips_query = {
+                    "parts": [f"{persona_prompt}을 참고하여 다음 재료들({', '.join(result.ingredients)})의 건강상 이점과 주의사항에 대해 조언해주세요. 다른 답변은 필요없습니다."]
+                }
             
-            # 대체 재료 및 조리 팁 결과 표시
-            if result.alternatives:
-                current_result += "🔄 대체 재료 제안:\n"
-                for idx, alt in enumerate(result.alternatives, 1):
-                    current_result += f"{idx}. {alt['원재료']} → {alt['대체재료']}\n"
-                    current_result += f"   이유: {alt['대체이유']}\n"
+                query_with_role = {'role': 'user', 'parts': health_tips_query['parts']}
+                history.append(query_with_role)
+            
+                health_tips_data = main.generate_structured_stage(history, "health_tips", usage_log, main.HEALTH_TIPS_SCHEMA, result.ingredients)
+                health_tips = main.parse_json_items(health_tips_data, "건강팁")
+                result.health_tips = health_tips
+            
+                # 건강 팁 결과 표시
+                current_result += "💊 건강 팁:\n"
+                for idx, (ingredient, tip) in enumerate(result.health_tips.items(), 1):
+                    current_result += f"{idx}. {ingredient}: {tip}\n"
                 current_result += "\n"
             
-            if result.cooking_tips:
-                current_result += "👨‍🍳 조리 팁:\n"
-                current_result += f"{result.cooking_tips}\n"
+                result_container.text_area("", value=current_result, height=700, disabled=True)
+                progress_bar.progress(75)
+            
+                # 4단계: 종합 평가 및 나머지 분석
+                status_text.text("종합 평가 및 추가 정보를 생성하는 중...")
+            
+                # 나머지 분석 과정 실행 (main.py의 나머지 부분)
+                # 여기서는 main.py의 나머지 분석 과정을 호출하는 대신 직접 구현
+            
+                # 종합 평가 쿼리
+                overall_query = {
+                    "parts": [f"{persona_prompt}을 참고하여 다음 재료들({', '.join(result.ingredients)})에 대한 종합적인 평가와 적합도, 추가 조언을 제공해주세요."]
+                }
+            
+                query_with_role = {'role': 'user', 'parts': overall_query['parts']}
+                history.append(query_with_role)
+            
+                overall_data = main.generate_structured_stage(history, "overall_assessment", usage_log, main.OVERALL_ASSESSMENT_SCHEMA)
+            
+                result.overall_assessment = overall_data.get("종합평가", "")
+                result.suitability = overall_data.get("적합도", "")
+                result.additional_advice = overall_data.get("추가조언", [])
+            
+                # 종합 평가 결과 표시
+                if result.overall_assessment:
+                    current_result += "🧐 종합 평가:\n"
+                    current_result += f"{result.overall_assessment}\n\n"
+            
+                if result.suitability:
+                    current_result += "⭐ 적합도:\n"
+                    current_result += f"{result.suitability}\n\n"
+            
+                if result.additional_advice:
+                    current_result += "💡 추가 조언:\n"
+                    for idx, advice in enumerate(result.additional_advice, 1):
+                        current_result += f"{idx}. [{advice['카테고리']}] {advice['내용']}\n"
+                    current_result += "\n"
+            
+                result_container.text_area("", value=current_result, height=700, disabled=True)
+                progress_bar.progress(90)
+            
+                # 5단계: 대체 재료 및 조리 팁
+                status_text.text("대체 재료 및 조리 팁을 생성하는 중...")
+            
+                alternatives_query = {
+                    "parts": [f"{persona_prompt}을 참고하여 다음 재료들({', '.join(result.ingredients)})의 건강에 더 좋은 대체 재료와 조리 팁을 제안해주세요."]
+                }
+            
+                query_with_role = {'role': 'user', 'parts': alternatives_query['parts']}
+                history.append(query_with_role)
+            
+                alternatives_data = main.generate_structured_stage(history, "alternatives", usage_log, main.ALTERNATIVES_SCHEMA, result.ingredients)
+            
+                result.alternatives = alternatives_data.get("alternatives", [])
+                result.cooking_tips = alternatives_data.get("조리팁", "")
+            
+                # 대체 재료 및 조리 팁 결과 표시
+                if result.alternatives:
+                    current_result += "🔄 대체 재료 제안:\n"
+                    for idx, alt in enumerate(result.alternatives, 1):
+                        current_result += f"{idx}. {alt['원재료']} → {alt['대체재료']}\n"
+                        current_result += f"   이유: {alt['대체이유']}\n"
+                    current_result += "\n"
+            
+                if result.cooking_tips:
+                    current_result += "👨‍🍳 조리 팁:\n"
+                    current_result += f"{result.cooking_tips}\n"
+            
+                # 최종 결과 표시
+                result_container.text_area("", value=current_result, height=700, disabled=True)
+                progress_bar.progress(100)
+                status_text.text("분석이 완료되었습니다!")
+            
+                # 단계별 토큰 사용량 및 지연 시간 표시
+                with st.expander("단계별 사용량"):
+                    st.text(main.format_usage_report(result.usage))
             
-            # 최종 결과 표시
-            result_container.text_area("", value=current_result, height=700, disabled=True)
-            progress_bar.progress(100)
-            status_text.text("분석이 완료되었습니다!")
+                # 최종 결과 저장
+                result_text = current_result
+                
+                # 분석이 끝난 대화 기록은 더 이상 필요 없으므로 바로 해제
+                del history
             
-            # 최종 결과 저장
-            result_text = current_result
+            result.memory = memory
+            with st.expander("메모리 사용량"):
+                st.text(main.format_memory_report(result.memory))
     
     # 출력 구조를 담을 텍스트 박스 추가 (분석 버튼을 누르지 않았을 때만 표시)
     if not analyze_button:
@@ -0,0 +1,378 @@
+# Streamlit 앱 동시 세션 부하 테스트
+#
+# 가짜 Gemini 백엔드(지연 시간 설정 가능)를 붙인 Streamlit 서버를 띄운 뒤,
+# 웹소켓(/_stcore/stream)으로 N개의 세션을 동시에 연결해 분석 흐름을 반복 실행합니다.
+# 동시 세션 수를 단계적으로 늘리면서 지연 시간 백분위, 처리량, 오류율, 서버 CPU/메모리를 보고합니다.
+#
+# 사용 예:
+#   python load_test.py --concurrency 1,2,4,8,16 --iterations 3 --latency 0.8 --jitter 0.2
+
+from typing import List, Optional, Dict, Any
+from types import SimpleNamespace
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_PATH = os.path.join(APP_DIR, "app.py")
+
+FAKE_INGREDIENTS = ["밀가루", "설탕", "식물성유지", "정제소금", "탈지분유"]
+
+# 분석 요청 시 입력할 위젯 값 (레이블 기준)
+ANALYSIS_INPUTS = {
+    "이미지 선택": 0,
+    "성별": 1,
+    "나이": 60,
+    "건강 이슈": [0, 1],
+    "목적": [0],
+}
+ANALYZE_BUTTON_LABEL = "분석 시작"
+
+# 분석이 실제로 끝까지 실행되었는지 확인하는 완료 메시지 (app.py의 status_text)
+COMPLETION_MARKER = "분석이 완료되었습니다!"
+
+
+# ---------------------------------------------------------------------------
+# 가짜 Gemini 백엔드 (서버 프로세스 안에서 main.genai.GenerativeModel을 대체)
+# ---------------------------------------------------------------------------
+
+def _fake_value(schema: Dict[str, Any], ingredient: str) -> Any:
+    schema_type = schema.get("type")
+    if schema_type == "array":
+        return [_fake_value(schema["items"], name) for name in FAKE_INGREDIENTS]
+    if schema_type == "object":
+        value = {}
+        for key, prop in schema.get("properties", {}).items():
+            if key in ("재료명", "원재료"):
+                value[key] = ingredient
+            else:
+                value[key] = _fake_value(prop, ingredient)
+        return value
+    return f"{ingredient}에 대한 테스트 응답입니다. " * 3
+
+class FakeGenerativeModel:
+    latency = 0.5
+    jitter = 0.0
+
+    def __init__(self, model_name, system_instruction=None, generation_config=None):
+        self.model_name = model_name
+
+    def generate_content(self, contents, generation_config=None):
+        # 실제 클라이언트처럼 스크립트 스레드를 블로킹
+        time.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+
+        response_schema = getattr(generation_config, "response_schema", None)
+        if isinstance(generation_config, dict):
+            response_schema = generation_config.get("response_schema")
+
+        if response_schema is None:
+            # 실제 응답처럼 구분자 주변 공백과 끝 줄바꿈을 포함
+            text = " ^ ".join(FAKE_INGREDIENTS) + "\n"
+        else:
+            text = json.dumps(_fake_value(response_schema, FAKE_INGREDIENTS[0]), ensure_ascii=False)
+
+        prompt_chars = sum(len(part) for turn in contents for part in turn["parts"] if isinstance(part, str))
+        usage_metadata = SimpleNamespace(prompt_token_count=prompt_chars // 4, candidates_token_count=len(text) // 2)
+        return SimpleNamespace(text=text, usage_metadata=usage_metadata)
+
+def serve(args):
+    import main
+
+    FakeGenerativeModel.latency = args.latency
+    FakeGenerativeModel.jitter = args.jitter
+    main.genai.GenerativeModel = FakeGenerativeModel
+
+    from streamlit.web import bootstrap
+
+    flag_options = {
+        "server_port": args.port,
+        "server_headless": True,
+        "server_runOnSave": False,
+        "server_fileWatcherType": "none",
+        "browser_gatherUsageStats": False,
+    }
+    os.chdir(APP_DIR)
+    bootstrap.load_config_options(flag_options=flag_options)
+    bootstrap.run(APP_PATH, False, [], flag_options)
+
+
+# ---------------------------------------------------------------------------
+# 세션 시뮬레이터 (Streamlit 웹소켓 프로토콜)
+# ---------------------------------------------------------------------------
+
+class SessionError(Exception):
+    pass
+
+def _rerun_message(widget_states: List[Any] = ()) -> bytes:
+    from streamlit.proto.BackMsg_pb2 import BackMsg
+
+    back_msg = BackMsg()
+    back_msg.rerun_script.SetInParent()
+    back_msg.rerun_script.query_string = ""
+    back_msg.rerun_script.widget_states.widgets.extend(widget_states)
+    return back_msg.SerializeToString()
+
+async def _run_script(conn, message: bytes, timeout: float) -> Dict[str, Any]:
+    from streamlit.proto.Alert_pb2 import Alert
+    from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+
+    widgets = {}
+    errors = []
+    completed = False
+    # timeout은 메시지 하나가 아니라 스크립트 실행 전체에 대한 기한
+    deadline = asyncio.get_running_loop().time() + timeout
+    await conn.write_message(message, binary=True)
+
+    while True:
+        remaining = deadline - asyncio.get_running_loop().time()
+        if remaining <= 0:
+            raise asyncio.TimeoutError()
+        raw = await asyncio.wait_for(conn.read_message(), remaining)
+        if raw is None:
+            raise SessionError("웹소켓 연결이 끊어졌습니다")
+
+        msg = ForwardMsg.FromString(raw)
+        msg_type = msg.WhichOneof("type")
+
+        if msg_type == "delta" and msg.delta.WhichOneof("type") == "new_element":
+            element = msg.delta.new_element
+            element_type = element.WhichOneof("type")
+            if element_type in ("radio", "selectbox", "number_input", "multiselect", "button"):
+                widget = getattr(element, element_type)
+                widgets[widget.label] = (element_type, widget)
+            elif element_type == "text" and element.text.body == COMPLETION_MARKER:
+                completed = True
+            elif element_type == "exception":
+                errors.append(f"{element.exception.type}: {element.exception.message}")
+            elif element_type == "alert" and element.alert.format == Alert.ERROR:
+                errors.append(element.alert.body)
+
+        elif msg_type == "script_finished":
+            if msg.script_finished == ForwardMsg.FINISHED_EARLY_FOR_RERUN:
+                continue
+            if msg.script_finished != ForwardMsg.FINISHED_SUCCESSFULLY:
+                errors.append(f"script_finished={msg.script_finished}")
+            return {"widgets": widgets, "errors": errors, "completed": completed}
+
+def _analysis_widget_states(widgets: Dict[str, Any]) -> List[Any]:
+    from streamlit.proto.NumberInput_pb2 import NumberInput
+    from streamlit.proto.WidgetStates_pb2 import WidgetState
+
+    states = []
+    for label, value in ANALYSIS_INPUTS.items():
+        if label not in widgets:
+            raise SessionError(f"위젯을 찾을 수 없습니다: {label}")
+        element_type, widget = widgets[label]
+        state = WidgetState(id=widget.id)
+        if element_type == "multiselect":
+            state.int_array_value.data.extend(value)
+        elif element_type == "number_input" and widget.data_type == NumberInput.FLOAT:
+            state.double_value = value
+        else:
+            state.int_value = value
+        states.append(state)
+
+    if ANALYZE_BUTTON_LABEL not in widgets:
+        raise SessionError(f"버튼을 찾을 수 없습니다: {ANALYZE_BUTTON_LABEL}")
+    states.append(WidgetState(id=widgets[ANALYZE_BUTTON_LABEL][1].id, trigger_value=True))
+    return states
+
+async def run_session(url: str, iterations: int, timeout: float) -> List[Dict[str, Any]]:
+    from tornado.websocket import WebSocketClosedError, websocket_connect
+
+    records = []
+    try:
+        conn = await asyncio.wait_for(websocket_connect(url), timeout)
+    except Exception as e:
+        return [{"latency": None, "error": f"연결 실패: {e}"}] * iterations
+
+    try:
+        # 첫 실행으로 위젯 ID를 수집
+        initial = await _run_script(conn, _rerun_message(), timeout)
+        widget_states = _analysis_widget_states(initial["widgets"])
+
+        for _ in range(iterations):
+            start = time.perf_counter()
+            try:
+                outcome = await _run_script(conn, _rerun_message(widget_states), timeout)
+                error = "; ".join(outcome["errors"]) or None
+                # 버튼 트리거가 반영되지 않으면 기본 템플릿만 그려지므로 성공으로 집계하지 않음
+                if error is None and not outcome["completed"]:
+                    error = "분석이 실행되지 않았습니다 (완료 메시지 없음)"
+            except asyncio.TimeoutError:
+                error = "시간 초과"
+            records.append({"latency": time.perf_counter() - start, "error": error})
+            if error == "시간 초과":
+                break
+    except (SessionError, WebSocketClosedError, asyncio.TimeoutError) as e:
+        records.append({"latency": None, "error": str(e) or "시간 초과"})
+    finally:
+        conn.close()
+
+    # 중단된 세션의 남은 요청은 오류로 집계
+    records += [{"latency": None, "error": "세션 중단"}] * (iterations - len(records))
+    return records
+
+
+# ---------------------------------------------------------------------------
+# 서버 리소스 측정 및 보고
+# ---------------------------------------------------------------------------
+
+def _server_cpu_seconds(pid: int) -> Optional[float]:
+    try:
+        with open(f"/proc/{pid}/stat") as stat:
+            fields = stat.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+
+def _server_rss_mb(pid: int) -> Optional[float]:
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+async def _sample_rss(pid: int, samples: List[float], stop: asyncio.Event, interval: float = 0.2):
+    while not stop.is_set():
+        rss = _server_rss_mb(pid)
+        if rss is not None:
+            samples.append(rss)
+        try:
+            await asyncio.wait_for(stop.wait(), interval)
+        except asyncio.TimeoutError:
+            pass
+
+async def run_level(url: str, pid: int, concurrency: int, iterations: int, timeout: float) -> Dict[str, Any]:
+    rss_samples: List[float] = []
+    stop = asyncio.Event()
+    sampler = asyncio.ensure_future(_sample_rss(pid, rss_samples, stop))
+
+    cpu_before = _server_cpu_seconds(pid)
+    start = time.perf_counter()
+    sessions = await asyncio.gather(*[run_session(url, iterations, timeout) for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    cpu_after = _server_cpu_seconds(pid)
+
+    stop.set()
+    await sampler
+
+    records = [record for session in sessions for record in session]
+    latencies = [record["latency"] for record in records if record["error"] is None]
+    errors = [record["error"] for record in records if record["error"] is not None]
+
+    return {
+        "concurrency": concurrency,
+        "requests": len(records),
+        "errors": len(errors),
+        "error_rate": len(errors) / len(records) if records else 0.0,
+        "p50": percentile(latencies, 50),
+        "p90": percentile(latencies, 90),
+        "p99": percentile(latencies, 99),
+        "throughput": len(latencies) / elapsed if elapsed else 0.0,
+        "cpu_percent": (cpu_after - cpu_before) / elapsed * 100 if cpu_before is not None and cpu_after is not None else None,
+        "peak_rss_mb": max(rss_samples) if rss_samples else None,
+        "error_samples": sorted(set(errors))[:3],
+    }
+
+def format_level(level: Dict[str, Any]) -> str:
+    def fmt(value, spec, unit):
+        return f"{format(value, spec)}{unit}" if value is not None else "n/a"
+
+    return (f"{level['concurrency']:>6} | {level['requests']:>5} | {level['error_rate'] * 100:>6.1f}% | "
+            f"{fmt(level['p50'], '.2f', 's'):>8} | {fmt(level['p90'], '.2f', 's'):>8} | {fmt(level['p99'], '.2f', 's'):>8} | "
+            f"{level['throughput']:>7.2f}/s | {fmt(level['cpu_percent'], '.1f', '%'):>7} | {fmt(level['peak_rss_mb'], '.1f', 'MB'):>9}")
+
+def _find_free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+def _wait_for_server(port: int, server: subprocess.Popen, timeout: float):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError("Streamlit 서버가 시작되지 못했습니다")
+        try:
+            with urllib.request.urlopen(f"http://localhost:{port}/_stcore/health", timeout=1) as response:
+                if response.status == 200:
+                    return
+        except OSError:
+            time.sleep(0.5)
+    raise RuntimeError("Streamlit 서버 응답 대기 시간이 초과되었습니다")
+
+async def run_load_test(args, pid: int) -> List[Dict[str, Any]]:
+    url = f"ws://localhost:{args.port}/_stcore/stream"
+    levels = []
+
+    print(f"가짜 Gemini 지연 시간: {args.latency}s (±{args.jitter}s), 세션당 분석 {args.iterations}회")
+    print("세션 수 |  요청 |  오류율 |      p50 |      p90 |      p99 |    처리량 |     CPU |  최대 RSS")
+    for concurrency in args.concurrency:
+        level = await run_level(url, pid, concurrency, args.iterations, args.timeout)
+        levels.append(level)
+        print(format_level(level))
+        for error in level["error_samples"]:
+            print(f"      오류: {error}")
+    return levels
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Streamlit 앱 동시 세션 부하 테스트")
+    parser.add_argument("--concurrency", default="1,2,4,8", type=lambda value: [int(item) for item in value.split(",")],
+                        help="단계별 동시 세션 수 (쉼표로 구분)")
+    parser.add_argument("--iterations", type=int, default=3, help="세션당 분석 반복 횟수")
+    parser.add_argument("--latency", type=float, default=0.5, help="가짜 Gemini 호출 지연 시간 (초)")
+    parser.add_argument("--jitter", type=float, default=0.1, help="지연 시간 변동 폭 (초)")
+    parser.add_argument("--port", type=int, default=None, help="테스트용 Streamlit 서버 포트 (기본값: 빈 포트 자동 선택)")
+    parser.add_argument("--timeout", type=float, default=120.0, help="스크립트 실행 한 번의 최대 대기 시간 (초)")
+    parser.add_argument("--output", help="결과를 저장할 JSON 파일 경로")
+    parser.add_argument("--server-log", help="Streamlit 서버 로그(stdout/stderr)를 저장할 파일 경로 (기본값: 버림)")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args)
+        return
+
+    if args.port is None:
+        args.port = _find_free_port()
+
+    # 서버 로그가 결과 표에 섞이지 않도록 stdout/stderr 모두 파일로 보내거나 버림
+    server_log = open(args.server_log, "w", encoding="utf-8") if args.server_log else subprocess.DEVNULL
+    try:
+        server = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve",
+                                   "--port", str(args.port), "--latency", str(args.latency), "--jitter", str(args.jitter)],
+                                  cwd=APP_DIR, stdout=server_log, stderr=subprocess.STDOUT)
+        try:
+            _wait_for_server(args.port, server, timeout=60)
+            levels = asyncio.run(run_load_test(args, server.pid))
+        finally:
+            server.terminate()
+            server.wait()
+    finally:
+        if args.server_log:
+            server_log.close()
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output:
+            json.dump(levels, output, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main_cli()
@@ -1,6 +1,13 @@
-from typing import List, Optional, Dict, Any, TypedDict
+from typing import List, Optional, Dict, Any, Tuple, TypedDict
+from contextlib import contextmanager
+import io
 import json
 import os
+import re
+import sys
+import threading
+import time
+import tracemalloc
 from dotenv import load_dotenv
 
 from pydantic import BaseModel, Field
@@ -8,6 +15,12 @@ from PIL import Image
 import google.generativeai as genai
 import streamlit as st
 
+try:
+    import resource
+except ImportError:
+    # Windows에서는 resource 모듈을 사용할 수 없음
+    resource = None
+
 # 환경 변수 로드
 load_dotenv()
 
@@ -23,9 +36,52 @@ genai.configure(api_key=API_KEY)
 
 IMAGE_PATH = '/content/drive/MyDrive/ocr/ocr_test_img_ko.png'
 MODEL_NAME = "gemini-2.0-flash"
+LIGHT_MODEL_NAME = "gemini-2.0-flash-lite"
 INGREDIENTS_TEMPERATURE = 0.2
 DESCRIPTION_TEMPERATURE = 0.7
 
+class StageConfig(TypedDict):
+    model: str
+    temperature: float
+    max_output_tokens: Optional[int]
+    max_output_tokens_per_entry: int
+
+# 단계별 모델/온도/출력 토큰 상한 설정
+# 출력 토큰 상한 = max_output_tokens + max_output_tokens_per_entry x 재료 수 (재료별로 답하는 단계)
+# 재료 추출 단계는 정확도가 가장 중요하므로 기본 모델을 그대로 사용하고 상한을 두지 않음
+STAGE_CONFIGS: Dict[str, StageConfig] = {
+    "ingredients": {"model": MODEL_NAME, "temperature": INGREDIENTS_TEMPERATURE, "max_output_tokens": None, "max_output_tokens_per_entry": 0},
+    "descriptions": {"model": LIGHT_MODEL_NAME, "temperature": DESCRIPTION_TEMPERATURE, "max_output_tokens": 256, "max_output_tokens_per_entry": 160},
+    "health_tips": {"model": MODEL_NAME, "temperature": DESCRIPTION_TEMPERATURE, "max_output_tokens": 256, "max_output_tokens_per_entry": 192},
+    "overall_assessment": {"model": MODEL_NAME, "temperature": DESCRIPTION_TEMPERATURE, "max_output_tokens": 1536, "max_output_tokens_per_entry": 0},
+    "alternatives": {"model": LIGHT_MODEL_NAME, "temperature": DESCRIPTION_TEMPERATURE, "max_output_tokens": 512, "max_output_tokens_per_entry": 128},
+}
+
+# 부하가 높을 때(동시 분석 수가 임계값 이상) 적용할 예산 정책
+# downgrade_stages에 포함된 단계만 경량 모델로 전환하고, 재료 수를 반영한 출력 토큰 상한 전체를 줄임
+BUDGET_POLICY: Dict[str, Any] = {
+    "high_load_threshold": 4,
+    "downgrade_stages": ["health_tips", "overall_assessment"],
+    "downgrade_model": LIGHT_MODEL_NAME,
+    "max_output_tokens_scale": 0.5,
+}
+
+# 구조화 응답에서 누락된 항목을 다시 요청하는 최대 횟수
+MAX_REGENERATION_ATTEMPTS = 1
+
+# 업로드용 이미지 설정 (디코딩된 이미지 대신 인코딩된 바이트만 보관)
+# 최대 변 길이를 넘는 이미지만 디코딩해서 축소하고, 나머지는 원본 파일 바이트를 그대로 전송
+MAX_IMAGE_SIDE = 2048
+IMAGE_JPEG_QUALITY = 90
+IMAGE_MIME_TYPES = {"PNG": "image/png", "JPEG": "image/jpeg", "WEBP": "image/webp"}
+
+# 분석 중 RSS 샘플링 간격 (초)
+RSS_SAMPLE_INTERVAL = 0.05
+
+# 분석별 tracemalloc 스냅샷 수집 여부
+TRACEMALLOC_ENABLED = os.getenv("TRACEMALLOC_ENABLED", "0") == "1"
+TRACEMALLOC_TOP_N = 10
+
 class PersonaType(TypedDict):
     gender: str
     age: int
@@ -151,20 +207,387 @@ class OCRResult(BaseModel):
     additional_advice: Optional[List[Dict[str, str]]] = Field(default=None, description="카테고리별 추가 조언")
     alternatives: Optional[List[Dict[str, str]]] = Field(default=None, description="건강에 더 좋은 대체 재료 제안")
     cooking_tips: Optional[str] = Field(default=None, description="건강에 더 좋은 조리법 제안")
+    usage: List["StageUsage"] = Field(default_factory=list, description="단계별 토큰 사용량 및 지연 시간")
+    memory: Optional["MemoryReport"] = Field(default=None, description="분석별 메모리 사용량")
+
+class StageUsage(BaseModel):
+    stage: str = Field(description="분석 단계 이름")
+    model: str = Field(description="실제 호출한 모델명")
+    prompt_tokens: int = Field(default=0, description="입력 토큰 수")
+    output_tokens: int = Field(default=0, description="출력 토큰 수")
+    latency_ms: float = Field(default=0.0, description="응답 지연 시간 (ms)")
+    downgraded: bool = Field(default=False, description="예산 정책에 의해 경량 모델로 전환되었는지 여부")
+    max_output_tokens: Optional[int] = Field(default=None, description="적용된 출력 토큰 상한")
+    finish_reason: str = Field(default="", description="응답 종료 사유 (MAX_TOKENS이면 상한에 의해 잘림)")
+
+class MemoryReport(BaseModel):
+    rss_before_mb: float = Field(default=0.0, description="분석 시작 시 RSS (MB)")
+    rss_after_mb: float = Field(default=0.0, description="분석 종료 시 RSS (MB)")
+    peak_rss_mb: float = Field(default=0.0, description="분석 중 샘플링한 최대 RSS (MB)")
+    process_peak_rss_mb: float = Field(default=0.0, description="프로세스 시작 이후 최대 RSS (MB)")
+    tracemalloc_peak_mb: Optional[float] = Field(default=None, description="분석 중 tracemalloc 최대 할당량 (MB)")
+    top_allocations: Optional[List[str]] = Field(default=None, description="tracemalloc 스냅샷 상위 할당 위치")
+
+OCRResult.model_rebuild()
+
+# 현재 진행 중인 분석 수 (예산 정책의 부하 지표)
+_active_analyses = 0
+_active_analyses_lock = threading.Lock()
+
+@contextmanager
+def track_load():
+    global _active_analyses
+    with _active_analyses_lock:
+        _active_analyses += 1
+    try:
+        yield
+    finally:
+        with _active_analyses_lock:
+            _active_analyses -= 1
+
+def current_load() -> int:
+    with _active_analyses_lock:
+        return _active_analyses
+
+def load_image_part(image_path) -> Dict[str, Any]:
+    # Image.open은 헤더만 읽으므로 크기/형식 확인에는 디코딩이 필요 없음
+    with Image.open(image_path) as source:
+        if max(source.size) <= MAX_IMAGE_SIDE and source.format in IMAGE_MIME_TYPES:
+            with open(image_path, "rb") as image_file:
+                return {"mime_type": IMAGE_MIME_TYPES[source.format], "data": image_file.read()}
+
+        # 큰 이미지(또는 지원하지 않는 형식)만 한 번 디코딩해서 축소 후 재인코딩
+        image = source.copy()
+
+    try:
+        image.thumbnail((MAX_IMAGE_SIDE, MAX_IMAGE_SIDE))
+        buffer = io.BytesIO()
+        # 투명도가 있는 이미지는 알파 채널을 잃지 않도록 PNG로 유지
+        if image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info:
+            image.save(buffer, format="PNG")
+            return {"mime_type": "image/png", "data": buffer.getvalue()}
+
+        rgb_image = image if image.mode in ("RGB", "L") else image.convert("RGB")
+        try:
+            rgb_image.save(buffer, format="JPEG", quality=IMAGE_JPEG_QUALITY)
+        finally:
+            rgb_image.close()
+        return {"mime_type": "image/jpeg", "data": buffer.getvalue()}
+    finally:
+        image.close()
+
+def release_image_parts(history: List[Dict[str, Any]]):
+    # 재료 추출 이후 단계는 재료명만 사용하므로 업로드가 끝난 이미지는 대화 기록에서 제거
+    for turn in history:
+        turn['parts'] = [part for part in turn['parts'] if not (isinstance(part, dict) and "mime_type" in part)]
+
+def _current_rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as statm:
+            resident_pages = int(statm.read().split()[1])
+        return resident_pages * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2
+    except (OSError, ValueError, AttributeError):
+        return 0.0
+
+def _process_peak_rss_mb() -> float:
+    if resource is None:
+        return 0.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS는 바이트, Linux는 KB 단위
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+def _sample_rss(report: MemoryReport, stop: threading.Event):
+    while not stop.wait(RSS_SAMPLE_INTERVAL):
+        report.peak_rss_mb = max(report.peak_rss_mb, _current_rss_mb())
+
+@contextmanager
+def memory_report(tracemalloc_enabled: bool = TRACEMALLOC_ENABLED):
+    # RSS와 tracemalloc은 프로세스 전역이므로 동시 분석이 있으면 다른 세션의 메모리도 함께 집계됨
+    rss_before_mb = _current_rss_mb()
+    report = MemoryReport(rss_before_mb=rss_before_mb, peak_rss_mb=rss_before_mb)
+    if tracemalloc_enabled:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+
+    # ru_maxrss는 프로세스 전체의 최대값이므로 분석 중 최대 RSS는 백그라운드 스레드에서 샘플링
+    stop = threading.Event()
+    sampler = threading.Thread(target=_sample_rss, args=(report, stop), daemon=True)
+    sampler.start()
+    try:
+        yield report
+    finally:
+        stop.set()
+        sampler.join()
+        report.rss_after_mb = _current_rss_mb()
+        report.peak_rss_mb = max(report.peak_rss_mb, report.rss_after_mb)
+        report.process_peak_rss_mb = _process_peak_rss_mb()
+        if tracemalloc_enabled:
+            _, peak = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot()
+            report.tracemalloc_peak_mb = peak / 1024 ** 2
+            report.top_allocations = [str(stat) for stat in snapshot.statistics("lineno")[:TRACEMALLOC_TOP_N]]
+
+def format_memory_report(report: MemoryReport) -> str:
+    lines = [f"RSS: {report.rss_before_mb:.1f}MB → {report.rss_after_mb:.1f}MB | 분석 중 최대 RSS: {report.peak_rss_mb:.1f}MB | 프로세스 최대 RSS: {report.process_peak_rss_mb:.1f}MB"]
+    if report.tracemalloc_peak_mb is not None:
+        lines.append(f"tracemalloc 최대 할당량: {report.tracemalloc_peak_mb:.1f}MB")
+        lines.extend(report.top_allocations or [])
+    return "\n".join(lines)
 
 def setup_persona():
     persona_prompt = f"사용자 정보: ({PERSONA['age']}세, {PERSONA['gender']}), 건강 이슈: {', '.join(PERSONA['health_issues'])}, 목적: {PERSONA['purpose']}"
     return persona_prompt
 
-def setup_gemini_model():
+def setup_gemini_model(model_name=MODEL_NAME):
     return genai.GenerativeModel(
-        MODEL_NAME,
+        model_name,
         system_instruction=SYSTEM_INSTRUCTION,
         generation_config=genai.GenerationConfig(temperature=INGREDIENTS_TEMPERATURE)
     )
 
+def resolve_stage_config(stage: str, load: Optional[int] = None, entry_count: int = 0) -> Tuple[StageConfig, bool]:
+    config: StageConfig = dict(STAGE_CONFIGS[stage])
+    if load is None:
+        load = current_load()
+
+    # 요청한 재료 수만큼 상한을 늘린 뒤, 부하가 높으면 늘린 상한 전체에 축소 비율을 적용
+    if config["max_output_tokens"] is not None:
+        config["max_output_tokens"] += config["max_output_tokens_per_entry"] * entry_count
+
+    downgraded = load >= BUDGET_POLICY["high_load_threshold"] and stage in BUDGET_POLICY["downgrade_stages"]
+    if downgraded:
+        config["model"] = BUDGET_POLICY["downgrade_model"]
+        if config["max_output_tokens"] is not None:
+            config["max_output_tokens"] = max(1, int(config["max_output_tokens"] * BUDGET_POLICY["max_output_tokens_scale"]))
+    return config, downgraded
+
+def generate_stage(history: List[Dict[str, Any]], stage: str, usage_log: List[StageUsage], response_schema: Optional[Dict[str, Any]] = None, entry_count: int = 0):
+    config, downgraded = resolve_stage_config(stage, entry_count=entry_count)
+    model = setup_gemini_model(config["model"])
+
+    schema_options = {}
+    if response_schema is not None:
+        schema_options = {"response_mime_type": "application/json", "response_schema": response_schema}
+    generation_config = genai.GenerationConfig(
+        temperature=config["temperature"],
+        max_output_tokens=config["max_output_tokens"],
+        **schema_options
+    )
+
+    start = time.perf_counter()
+    response = model.generate_content(history, generation_config=generation_config)
+    latency_ms = (time.perf_counter() - start) * 1000
+
+    usage_metadata = getattr(response, "usage_metadata", None)
+    candidates = getattr(response, "candidates", None) or []
+    finish_reason = getattr(candidates[0], "finish_reason", "") if candidates else ""
+    usage_log.append(StageUsage(
+        stage=stage,
+        model=config["model"],
+        prompt_tokens=getattr(usage_metadata, "prompt_token_count", 0) or 0,
+        output_tokens=getattr(usage_metadata, "candidates_token_count", 0) or 0,
+        latency_ms=latency_ms,
+        downgraded=downgraded,
+        max_output_tokens=config["max_output_tokens"],
+        finish_reason=getattr(finish_reason, "name", str(finish_reason))
+    ))
+    return response
+
+def format_usage_report(usage: List[StageUsage]) -> str:
+    lines = []
+    for item in usage:
+        downgraded = " (경량 전환)" if item.downgraded else ""
+        truncated = " (상한 도달로 잘림)" if item.finish_reason == "MAX_TOKENS" else ""
+        limit = item.max_output_tokens if item.max_output_tokens is not None else "-"
+        lines.append(f"{item.stage}: {item.model}{downgraded} | 입력 {item.prompt_tokens} / 출력 {item.output_tokens} (상한 {limit}) 토큰{truncated} | {item.latency_ms:.0f}ms")
+    total_tokens = sum(item.prompt_tokens + item.output_tokens for item in usage)
+    total_latency = sum(item.latency_ms for item in usage)
+    lines.append(f"합계: {total_tokens} 토큰 | {total_latency:.0f}ms")
+    return "\n".join(lines)
+
+def repair_json(text: str) -> Any:
+    text = text.strip()
+    # 코드 블록(```json ... ```)으로 감싼 응답 처리
+    if text.startswith("```"):
+        text = text.split("\n", 1)[-1].rsplit("```", 1)[0]
+
+    starts = [index for index in (text.find("["), text.find("{")) if index >= 0]
+    if not starts:
+        return None
+    text = text[min(starts):]
+
+    # 정상 JSON 뒤에 불필요한 텍스트가 붙은 경우
+    try:
+        return json.JSONDecoder().raw_decode(text)[0]
+    except json.JSONDecodeError:
+        pass
+
+    # 문자열/괄호 상태를 추적하면서 후행 쉼표를 제거하고, 잘림 복구에 쓸 쉼표 위치를 기록
+    out: List[str] = []
+    stack: List[str] = []
+    cut_points = []
+    in_string = False
+    escaped = False
+    for char in text:
+        if in_string:
+            out.append(char)
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+            continue
+
+        if char == '"':
+            in_string = True
+        elif char in "[{":
+            stack.append("]" if char == "[" else "}")
+        elif char in "]}":
+            while out and out[-1] in ", \n\r\t":
+                out.pop()
+            if stack:
+                stack.pop()
+        elif char == ",":
+            cut_points.append((len(out), list(stack)))
+        out.append(char)
+
+        if not stack and char in "]}":
+            break
+
+    # 전체 텍스트를 먼저 닫아보고, 실패하면 마지막으로 완결된 항목까지 잘라서 닫음
+    # 문자열 중간에서 잘린 경우 마지막 항목은 미완성이므로 닫지 않고 마지막 쉼표 위치까지만 사용
+    candidates = [] if in_string else [("".join(out), stack)]
+    candidates += [("".join(out[:cut]), cut_stack) for cut, cut_stack in reversed(cut_points)]
+    for fragment, open_stack in candidates:
+        try:
+            return json.loads(fragment.rstrip().rstrip(",") + "".join(reversed(open_stack)))
+        except json.JSONDecodeError:
+            continue
+    return None
+
+def _schema_default(schema: Dict[str, Any]) -> Any:
+    if schema.get("type") == "array":
+        return []
+    if schema.get("type") == "object":
+        return {key: _schema_default(prop) for key, prop in schema.get("properties", {}).items() if key in schema.get("required", [])}
+    return ""
+
+def _is_empty(value: Any) -> bool:
+    if isinstance(value, dict):
+        return all(_is_empty(item) for item in value.values())
+    if isinstance(value, str):
+        return not value.strip()
+    return value in ([], None)
+
+def _is_complete(item: Any, schema: Dict[str, Any]) -> bool:
+    if schema.get("type") != "object":
+        return not _is_empty(item)
+    return not _is_empty(item) and all(not _is_empty(item.get(key)) for key in schema.get("required", []))
+
+def _normalize_name(name: Any) -> str:
+    # 괄호 안 원산지/세부 원료 표기와 공백, 문장부호를 제거해서 비교 (예: "밀가루(밀:미국산)" → "밀가루")
+    if not isinstance(name, str):
+        return ""
+    base = re.sub(r"\([^()]*\)|\[[^\[\]]*\]|\{[^{}]*\}", "", name)
+    normalized = re.sub(r"[\W_]", "", base) or re.sub(r"[\W_]", "", name)
+    return normalized.lower()
+
+def _names_match(left: Any, right: Any) -> bool:
+    # 모델이 재료명을 줄이거나 일부만 쓰는 경우가 많으므로 포함 관계도 같은 재료로 취급
+    left, right = _normalize_name(left), _normalize_name(right)
+    return bool(left and right) and (left == right or left in right or right in left)
+
+def conform_to_schema(data: Any, schema: Dict[str, Any]) -> Any:
+    schema_type = schema.get("type")
+
+    if schema_type == "array":
+        # 배열 대신 배열 하나를 감싼 객체로 응답한 경우
+        if isinstance(data, dict):
+            data = next((value for value in data.values() if isinstance(value, list)), [])
+        if not isinstance(data, list):
+            return []
+        # 필수 값이 하나라도 빈 항목은 제외 (재료별 배열은 누락 재료로 다시 요청됨)
+        items = [conform_to_schema(item, schema["items"]) for item in data]
+        return [item for item in items if _is_complete(item, schema["items"])]
+
+    if schema_type == "object":
+        if not isinstance(data, dict):
+            data = {}
+        conformed = {}
+        for key, prop in schema.get("properties", {}).items():
+            if key in data:
+                conformed[key] = conform_to_schema(data[key], prop)
+            elif key in schema.get("required", []):
+                conformed[key] = _schema_default(prop)
+        return conformed
+
+    if schema_type == "string":
+        if data is None:
+            return ""
+        return data if isinstance(data, str) else json.dumps(data, ensure_ascii=False)
+
+    return data
+
+def find_missing_entries(data: Any, schema: Dict[str, Any], ingredients: Optional[List[str]] = None) -> List[str]:
+    # 배열 스키마: 재료별 항목 중 누락되었거나 필수 값이 빈 재료
+    if schema.get("type") == "array":
+        # 완성된 항목 수가 재료 수 이상이면 이름이 달라도 (분리/축약) 누락으로 보지 않음
+        if len(data) >= len(ingredients or []):
+            return []
+        names = [item.get("재료명") for item in data]
+        return [ingredient for ingredient in ingredients or [] if not any(_names_match(ingredient, name) for name in names)]
+
+    # 객체 스키마: 값이 비어 있는 필수 필드
+    return [key for key in schema.get("required", []) if _is_empty(data.get(key))]
+
+def _merge_regenerated(data: Any, regenerated: Any, schema: Dict[str, Any], missing: List[str]) -> Any:
+    if schema.get("type") == "array":
+        regenerated_items = [item for item in regenerated
+                             if any(_names_match(item.get("재료명"), name) for name in missing)]
+        merged = [item for item in data
+                  if not any(_names_match(item.get("재료명"), new_item.get("재료명")) for new_item in regenerated_items)]
+        return merged + regenerated_items
+
+    merged = dict(data)
+    for key in missing:
+        if not _is_empty(regenerated.get(key)):
+            merged[key] = regenerated[key]
+    return merged
+
+def generate_structured_stage(history: List[Dict[str, Any]], stage: str, usage_log: List[StageUsage], response_schema: Dict[str, Any], ingredients: Optional[List[str]] = None) -> Any:
+    response = generate_stage(history, stage, usage_log, response_schema, entry_count=len(ingredients or []))
+    data = conform_to_schema(repair_json(response.text), response_schema)
+
+    # 누락된 항목만 다시 요청 (전체 파이프라인 재실행 없이)
+    for _ in range(MAX_REGENERATION_ATTEMPTS):
+        missing = find_missing_entries(data, response_schema, ingredients)
+        if not missing:
+            break
+
+        if response_schema.get("type") == "array":
+            retry_schema = response_schema
+            retry_prompt = f"다음 재료에 대한 답변이 누락되었습니다: {', '.join(missing)}. 이 재료들에 대해서만 같은 형식으로 다시 답변해주세요."
+        else:
+            properties = response_schema["properties"]
+            retry_schema = {"type": "object", "properties": {key: properties[key] for key in missing}, "required": missing}
+            retry_prompt = f"이전 답변에서 다음 항목이 누락되었습니다: {', '.join(missing)}. 해당 항목만 다시 답변해주세요."
+
+        retry_history = history + [{'role': 'model', 'parts': [json.dumps(data, ensure_ascii=False)]},
+                                   {'role': 'user', 'parts': [retry_prompt]}]
+        # 배열 스키마는 누락된 재료 수만큼, 객체 스키마는 재료별 배열 필드가 있을 수 있으므로 전체 재료 수 기준
+        retry_entry_count = len(missing) if response_schema.get("type") == "array" else len(ingredients or [])
+        retry_response = generate_stage(retry_history, stage, usage_log, retry_schema, entry_count=retry_entry_count)
+        regenerated = conform_to_schema(repair_json(retry_response.text), retry_schema)
+        data = _merge_regenerated(data, regenerated, response_schema, missing)
+
+    # 다음 단계에는 복구된 JSON을 대화 기록으로 전달
+    history.append({'role': 'model', 'parts': [json.dumps(data, ensure_ascii=False)]})
+    return data
+
 def parse_ingredients(text: str) -> OCRResult:
-    ingredients = [ingredient for ingredient in text.split('^')]
+    ingredients = [ingredient.strip() for ingredient in text.split('^') if ingredient.strip()]
     print("첫 번째 질문 정규화 :", ingredients)
     print("-"*100)
     return OCRResult(ingredients=ingredients)
@@ -181,30 +604,43 @@ def parse_json_items(items: List[Dict[str, Any]], key_name: str) -> Dict[str, st
 
 
 def analyze_food_ingredients(image_path=IMAGE_PATH):
-    image = Image.open(image_path)
-    model = setup_gemini_model()
+    with track_load(), memory_report() as report:
+        result = _analyze_food_ingredients(image_path)
+    result.memory = report
+    print("메모리 사용량 :\n" + format_memory_report(report))
+    print("-"*100)
+    return result
+
+def _analyze_food_ingredients(image_path):
+    image_part = load_image_part(image_path)
     persona_prompt = setup_persona()
+    usage_log: List[StageUsage] = []
 
     # 첫 번째 쿼리 (시스템 인스트럭션 포함)
     system_prompt = f"{SYSTEM_INSTRUCTION}\n\n{persona_prompt}"
     ingredient_query = {
         "parts": [system_prompt + "\n\n이미지에서 식품에 들어간 재료를 정확히 추출해서 '^'로 구분하여 나열해주세요. 단, 식재료 영역에 감지된 객체만 보여주세요. 다른 영역은 필요없습니다. 다른 답변도 필요하지마세요.",
-                 image]
+                 image_part]
     }
+    del image_part
 
     history = []
 
     query_with_role = {'role': 'user', 'parts': ingredient_query['parts']}
     history.append(query_with_role)
-    print("첫 번째 질문 누적 :", history)
+    image_label = f"<{ingredient_query['parts'][1]['mime_type']} {len(ingredient_query['parts'][1]['data'])} bytes>"
+    print("첫 번째 질문 누적 :", [{'role': 'user', 'parts': [ingredient_query['parts'][0], image_label]}])
     print("-"*100)
 
-    ingredient_response = model.generate_content(history)
+    ingredient_response = generate_stage(history, "ingredients", usage_log)
     history.append({'role': 'model', 'parts': [ingredient_response.text]})
+    release_image_parts(history)
+    del ingredient_query
     print("첫 질문 응답 누적 :", history)
     print("-"*100)
 
     result = parse_ingredients(ingredient_response.text)
+    result.usage = usage_log
     print("첫 질문 응답 구조화 :", result)
     print("-"*100)
 
@@ -218,20 +654,10 @@ def analyze_food_ingredients(image_path=IMAGE_PATH):
     print("두 번째 질문 누적 :", history)
     print("-"*100)
 
-    description_response = model.generate_content(
-        history,
-        generation_config=genai.GenerationConfig(
-            temperature=DESCRIPTION_TEMPERATURE,
-            response_mime_type="application/json",
-            response_schema=INGREDIENT_DESCRIPTION_SCHEMA
-        )
-    )
-
-    history.append({'role': 'model', 'parts': [description_response.text]})
+    description_data = generate_structured_stage(history, "descriptions", usage_log, INGREDIENT_DESCRIPTION_SCHEMA, result.ingredients)
     print("두 번째 응답 누적 :", history)
     print("-"*100)
 
-    description_data = json.loads(description_response.text)
     print("두 번째 응답 정규화 : ", description_data)
     print("-"*100)
 
@@ -250,20 +676,10 @@ def analyze_food_ingredients(image_path=IMAGE_PATH):
     print("세 번째 질문 누적 : ", history)
     print("-"*100)
 
-    health_tips_response = model.generate_content(
-        history,
-        generation_config=genai.GenerationConfig(
-            temperature=DESCRIPTION_TEMPERATURE,
-            response_mime_type="application/json",
-            response_schema=HEALTH_TIPS_SCHEMA
-        )
-    )
-
-    history.append({'role': 'model', 'parts': [health_tips_response.text]})
+    health_tips_data = generate_structured_stage(history, "health_tips", usage_log, HEALTH_TIPS_SCHEMA, result.ingredients)
     print("세 번째 응답 누적 : ", history)
     print("-"*100)
 
-    health_tips_data = json.loads(health_tips_response.text)
     print("세 번째 응답 정규화 : ", health_tips_data)
     print("-"*100)
 
@@ -282,20 +698,10 @@ def analyze_food_ingredients(image_path=IMAGE_PATH):
     print("네 번째 질문 누적 : ", history)
     print("-"*100)
 
-    overall_assessment_response = model.generate_content(
-        history,
-        generation_config=genai.GenerationConfig(
-            temperature=DESCRIPTION_TEMPERATURE,
-            response_mime_type="application/json",
-            response_schema=OVERALL_ASSESSMENT_SCHEMA
-        )
-    )
-
-    history.append({'role': 'model', 'parts': [overall_assessment_response.text]})
+    overall_assessment_data = generate_structured_stage(history, "overall_assessment", usage_log, OVERALL_ASSESSMENT_SCHEMA)
     print("네 번째 응답 누적 : ", history)
     print("-"*100)
 
-    overall_assessment_data = json.loads(overall_assessment_response.text)
     print("네 번째 응답 정규화 : ", overall_assessment_data)
     print("-"*100)
 
@@ -315,20 +721,10 @@ def analyze_food_ingredients(image_path=IMAGE_PATH):
     print("다섯 번째 질문 누적 : ", history)
     print("-"*100)
 
-    alternatives_response = model.generate_content(
-        history,
-        generation_config=genai.GenerationConfig(
-            temperature=DESCRIPTION_TEMPERATURE,
-            response_mime_type="application/json",
-            response_schema=ALTERNATIVES_SCHEMA
-        )
-    )
-
-    history.append({'role': 'model', 'parts': [alternatives_response.text]})
+    alternatives_data = generate_structured_stage(history, "alternatives", usage_log, ALTERNATIVES_SCHEMA, result.ingredients)
     print("다섯 번째 응답 누적 : ", history)
     print("-"*100)
 
-    alternatives_data = json.loads(alternatives_response.text)
     print("다섯 번째 응답 정규화 : ", alternatives_data)
     print("-"*100)
 
@@ -337,6 +733,9 @@ def analyze_food_ingredients(image_path=IMAGE_PATH):
     print("다섯 번째 응답 구조화 : ", result)
     print("-"*100)
 
+    print("단계별 사용량 :\n" + format_usage_report(result.usage))
+    print("-"*100)
+
     return result
 
 